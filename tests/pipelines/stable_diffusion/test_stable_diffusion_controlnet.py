@@ -26,6 +26,7 @@ from diffusers import (
     ControlNetModel,
     DDIMScheduler,
     StableDiffusionControlNetPipeline,
+    StableDiffusionPipeline,
     UNet2DConditionModel,
 )
 from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion_controlnet import MultiControlNetModel
@@ -34,7 +35,7 @@ from diffusers.utils.import_utils import is_xformers_available
 from diffusers.utils.testing_utils import require_torch_gpu
 
 from ..pipeline_params import TEXT_TO_IMAGE_BATCH_PARAMS, TEXT_TO_IMAGE_PARAMS
-from ..test_pipelines_common import PipelineTesterMixin
+from ..test_pipelines_common import PipelineTesterMixin, reset_cuda_memory_stats
 
 
 class StableDiffusionControlNetPipelineFastTests(PipelineTesterMixin, unittest.TestCase):
@@ -42,6 +43,11 @@ class StableDiffusionControlNetPipelineFastTests(PipelineTesterMixin, unittest.T
     params = TEXT_TO_IMAGE_PARAMS
     batch_params = TEXT_TO_IMAGE_BATCH_PARAMS
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tokenizer = CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip")
+
     def get_dummy_components(self):
         torch.manual_seed(0)
         unet = UNet2DConditionModel(
@@ -93,7 +99,11 @@ class StableDiffusionControlNetPipelineFastTests(PipelineTesterMixin, unittest.T
             vocab_size=1000,
         )
         text_encoder = CLIPTextModel(text_encoder_config)
-        tokenizer = CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip")
+        tokenizer = self.tokenizer
+
+        unet = unet.to(memory_format=torch.channels_last)
+        controlnet = controlnet.to(memory_format=torch.channels_last)
+        vae = vae.to(memory_format=torch.channels_last)
 
         components = {
             "unet": unet,
@@ -119,6 +129,7 @@ class StableDiffusionControlNetPipelineFastTests(PipelineTesterMixin, unittest.T
             generator=generator,
             device=torch.device(device),
         )
+        image = image.contiguous(memory_format=torch.channels_last)
 
         inputs = {
             "prompt": "A painting of a squirrel eating a burger",
@@ -150,6 +161,11 @@ class StableDiffusionMultiControlNetPipelineFastTests(PipelineTesterMixin, unitt
     params = TEXT_TO_IMAGE_PARAMS
     batch_params = TEXT_TO_IMAGE_BATCH_PARAMS
 
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tokenizer = CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip")
+
     def get_dummy_components(self):
         torch.manual_seed(0)
         unet = UNet2DConditionModel(
@@ -210,7 +226,12 @@ class StableDiffusionMultiControlNetPipelineFastTests(PipelineTesterMixin, unitt
             vocab_size=1000,
         )
         text_encoder = CLIPTextModel(text_encoder_config)
-        tokenizer = CLIPTokenizer.from_pretrained("hf-internal-testing/tiny-random-clip")
+        tokenizer = self.tokenizer
+
+        unet = unet.to(memory_format=torch.channels_last)
+        controlnet1 = controlnet1.to(memory_format=torch.channels_last)
+        controlnet2 = controlnet2.to(memory_format=torch.channels_last)
+        vae = vae.to(memory_format=torch.channels_last)
 
         controlnet = MultiControlNetModel([controlnet1, controlnet2])
 
@@ -246,6 +267,7 @@ class StableDiffusionMultiControlNetPipelineFastTests(PipelineTesterMixin, unitt
                 device=torch.device(device),
             ),
         ]
+        images = [image.contiguous(memory_format=torch.channels_last) for image in images]
 
         inputs = {
             "prompt": "A painting of a squirrel eating a burger",
@@ -302,17 +324,42 @@ class StableDiffusionMultiControlNetPipelineFastTests(PipelineTesterMixin, unitt
 @slow
 @require_torch_gpu
 class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # all ControlNet checkpoints share the same Stable Diffusion weights, so only load them once
+        cls.sd_components = StableDiffusionPipeline.from_pretrained(
+            "runwayml/stable-diffusion-v1-5", safety_checker=None
+        ).components
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.sd_components
+        super().tearDownClass()
+
     def tearDown(self):
         super().tearDown()
+        from accelerate.hooks import remove_hook_from_module
+
+        # drop the offloading hooks so that the next test starts from the plain shared modules on cpu
+        for component in self.sd_components.values():
+            if isinstance(component, torch.nn.Module):
+                remove_hook_from_module(component, recurse=True)
+                component.to("cpu")
         gc.collect()
         torch.cuda.empty_cache()
 
+    def get_pipeline(self, controlnet):
+        components = dict(self.sd_components)
+        # schedulers keep state between calls, so every test gets a fresh one
+        scheduler = components["scheduler"]
+        components["scheduler"] = scheduler.__class__.from_config(scheduler.config)
+        return StableDiffusionControlNetPipeline(**components, controlnet=controlnet)
+
     def test_canny(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-canny")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -337,9 +384,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
     def test_depth(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-depth")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -364,9 +409,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
     def test_hed(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-hed")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -391,9 +434,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
     def test_mlsd(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-mlsd")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -418,9 +459,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
     def test_normal(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-normal")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -445,9 +484,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
     def test_openpose(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-openpose")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -472,9 +509,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
     def test_scribble(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-scribble")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -499,9 +534,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
     def test_seg(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-seg")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -524,9 +557,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
         assert np.abs(expected_image - image).max() < 5e-3
 
     def test_sequential_cpu_offloading(self):
-        torch.cuda.empty_cache()
-        torch.cuda.reset_max_memory_allocated()
-        torch.cuda.reset_peak_memory_stats()
+        reset_cuda_memory_stats()
 
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-seg")
 
@@ -556,9 +587,7 @@ class StableDiffusionControlNetPipelineSlowTests(unittest.TestCase):
     def test_canny_guess_mode(self):
         controlnet = ControlNetModel.from_pretrained("lllyasviel/sd-controlnet-canny")
 
-        pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5", safety_checker=None, controlnet=controlnet
-        )
+        pipe = self.get_pipeline(controlnet)
         pipe.enable_model_cpu_offload()
         pipe.set_progress_bar_config(disable=None)
 
@@ -12,6 +12,7 @@ import torch
 
 import diffusers
 from diffusers import DiffusionPipeline
+from diffusers.models.attention_processor import AttnProcessor2_0
 from diffusers.utils import logging
 from diffusers.utils.import_utils import is_accelerate_available, is_accelerate_version, is_xformers_available
 from diffusers.utils.testing_utils import require_torch, torch_device
@@ -27,6 +28,25 @@ def to_np(tensor):
     return tensor
 
 
+def uses_flash_attention(*models):
+    # flash attention never materializes the attention matrix, which makes attention slicing redundant
+    if not torch.cuda.is_available() or torch.cuda.get_device_capability() < (8, 0):
+        return False
+
+    return all(
+        model.dtype in (torch.float16, torch.bfloat16)
+        and all(isinstance(processor, AttnProcessor2_0) for processor in model.attn_processors.values())
+        for model in models
+    )
+
+
+def reset_cuda_memory_stats():
+    # a single synchronizing reset before a measured region
+    torch.cuda.synchronize()
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats()
+
+
 @require_torch
 class PipelineTesterMixin:
     """